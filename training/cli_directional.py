@@ -67,6 +67,18 @@ def parse_args():
         type=int,
         help="Length of the ReplayBuffer",
     )
+    parser.add_argument(
+        "--buffer-storage",
+        default="device",
+        choices=["device", "cpu", "memmap"],
+        help=(
+            "Where to keep the ReplayBuffer. 'device' keeps it on the training device;"
+            " 'cpu' keeps it in pinned host memory to free up GPU memory, copying each"
+            " sampled minibatch over asynchronously; 'memmap' is like 'cpu' but backs"
+            " the buffer with memory-mapped files, so that its size isn't bounded by"
+            " the available memory."
+        ),
+    )
     parser.add_argument(
         "--epsilon-bounds",
         "-e",
@@ -88,6 +100,18 @@ def parse_args():
         help="How many steps to take in each batch from the data collector.",
     )
 
+    parser.add_argument(
+        "--num-envs",
+        "-n",
+        default=1,
+        type=int,
+        help=(
+            "How many environments to step in parallel worker processes while"
+            " collecting data. With a single environment, it is stepped in the main"
+            " process."
+        ),
+    )
+
     parser.add_argument(
         "--total-steps",
         "-T",
@@ -104,6 +128,24 @@ def parse_args():
         help="How many passes of the optimizer to make during each batch sample",
     )
 
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help=(
+            "Compile the DQN loss with torch.compile. Uses CUDA graphs to cut the"
+            " kernel launch overhead of each optimizer step when running on a GPU."
+        ),
+    )
+
+    parser.add_argument(
+        "--amp",
+        action="store_true",
+        help=(
+            "Run the forward pass of the DQN loss under bfloat16 autocast. The"
+            " optimizer state is kept in float32."
+        ),
+    )
+
     args = parser.parse_args()
 
     return args
@@ -1,266 +1,344 @@
-# %%
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import cli_directional
 import torch
+from exploration import AnnealedEGreedyModule
 from snake.envs import SnakeGrid
 from snake.render.asciinema import render_trajectory
 from tensordict import TensorDict
 from tensordict.nn import TensorDictSequential as Seq
+from torch.optim import Adam
+from torchrl._utils import logger as torchrl_logger
+from torchrl.collectors import MultiSyncDataCollector, SyncDataCollector
+from torchrl.data import LazyMemmapStorage, LazyTensorStorage, ReplayBuffer
 from torchrl.envs import (
     CatTensors,
     DTypeCastTransform,
+    EnvCreator,
     ExplorationType,
     GymEnv,
     StepCounter,
     TransformedEnv,
     set_exploration_type,
 )
-from torchrl.modules import MLP, EGreedyModule, QValueActor
+from torchrl.modules import MLP, QValueActor
+from torchrl.objectives import DQNLoss, SoftUpdate
+from trajectories import episode_bounds
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-torch.set_default_device(device)
 
-# %%
 
-# Parse arguments and set up environment, transforming outputs as needed to
-# make them compatible with the inputs of our approximation modules
+def make_env(board_size, max_episode_steps):
+    # Lives at module level so that it can be shipped to the collector's worker
+    # processes
+    env = GymEnv("snake/SnakeDirectional", size=board_size, render_mode="ansi")
+    try:
+        env.auto_register_info_dict()
+    except Exception:
+        pass
+    env = TransformedEnv(env, CatTensors(["food", "danger"], "observation"))
+    env = TransformedEnv(
+        env, DTypeCastTransform(torch.int8, torch.float32, in_keys="observation")
+    )
+    env = TransformedEnv(env, StepCounter(max_steps=max_episode_steps))
 
-args = cli_directional.parse_args()
+    return env
 
-# %%
-env = GymEnv("snake/SnakeDirectional", size=args.board_size, render_mode="ansi")
-try:
-    env.auto_register_info_dict()
-except Exception:
-    pass
-env = TransformedEnv(env, CatTensors(["food", "danger"], "observation"))
-env = TransformedEnv(
-    env, DTypeCastTransform(torch.int8, torch.float32, in_keys="observation")
-)
-env = TransformedEnv(env, StepCounter(max_steps=args.max_episode_steps))
 
-# %%
-env.reset()
+def main():
+    torch.set_default_device(device)
 
-# Set up value approximator, policy, exploration modules
+    # Parse arguments and set up environment, transforming outputs as needed to
+    # make them compatible with the inputs of our approximation modules
 
-value_net = MLP(depth=2, num_cells=[64, 64], out_features=4)
-policy = QValueActor(value_net, spec=env.action_spec)
-policy(env.fake_tensordict())
+    args = cli_directional.parse_args()
 
+    env = make_env(args.board_size, args.max_episode_steps)
 
-env.reset()
-rollout = env.rollout(max_steps=5, policy=policy)
-env.reset()
+    env.reset()
 
-# %%
-exploration_module = EGreedyModule(
-    env.action_spec,
-    annealing_num_steps=args.buffer_length * args.optim_steps,
-    eps_init=args.epsilon_bounds[0],
-    eps_end=args.epsilon_bounds[1],
-)
+    # Set up value approximator, policy, exploration modules. The input size is
+    # read off the observation spec so that the network is fully initialized
+    # without a lazy first forward pass.
 
-policy_explore = Seq(policy, exploration_module)
+    value_net = MLP(
+        in_features=env.observation_spec["observation"].shape[-1],
+        depth=2,
+        num_cells=[64, 64],
+        out_features=4,
+    )
+    policy = QValueActor(value_net, spec=env.action_spec)
 
-# %%
+    exploration_module = AnnealedEGreedyModule(
+        env.action_spec,
+        annealing_num_steps=args.buffer_length * args.optim_steps,
+        eps_init=args.epsilon_bounds[0],
+        eps_end=args.epsilon_bounds[1],
+    )
 
-# Set up interfaces for storing data and sampling rollouts
+    policy_explore = Seq(policy, exploration_module)
+
+    # Set up interfaces for storing data and sampling rollouts
+
+    if args.num_envs > 1:
+        # Each worker process steps its own copy of the environment; the batches
+        # from the workers are stacked along a leading dimension
+        collector = MultiSyncDataCollector(
+            [EnvCreator(partial(make_env, args.board_size, args.max_episode_steps))]
+            * args.num_envs,
+            policy_explore,
+            frames_per_batch=args.steps_per_batch,
+            total_frames=-1,
+            init_random_frames=args.init_rand_steps,
+            device=device,
+            cat_results="stack",
+        )
+    else:
+        collector = SyncDataCollector(
+            env,
+            policy_explore,
+            frames_per_batch=args.steps_per_batch,
+            total_frames=-1,
+            init_random_frames=args.init_rand_steps,
+            device=device,
+        )
+
+    # The observations are binary, so they are stored as uint8 and only cast back to
+    # float32 once a sampled minibatch is on the training device (keeping
+    # host-to-device copies small too)
+    obs_keys = ["observation", ("next", "observation")]
+    obs_cast = DTypeCastTransform(
+        torch.uint8, torch.float32, in_keys=obs_keys, in_keys_inv=obs_keys
+    )
+    if args.buffer_storage == "device":
+        storage_device = device
+    else:
+        storage_device = torch.device("cpu")
+    if args.buffer_storage == "memmap":
+        storage = LazyMemmapStorage(args.buffer_length)
+    else:
+        storage = LazyTensorStorage(args.buffer_length, device=storage_device)
+    rb = ReplayBuffer(
+        storage=storage,
+        pin_memory=storage_device != device,
+    )
 
-from torchrl.collectors import SyncDataCollector
-from torchrl.data import LazyTensorStorage, ReplayBuffer
+    loss = DQNLoss(value_network=policy, action_space=env.action_spec, delay_value=True)
+    loss.make_value_estimator(gamma=args.gamma)
+    # The fused implementation updates all of the (small) parameter tensors in a
+    # single kernel
+    optim = Adam(
+        loss.parameters(), lr=args.adam_learning_rate, fused=device.type == "cuda"
+    )
+    updater = SoftUpdate(loss, eps=0.99)
+    # The optimizer and target updater hold on to the eager module; only the forward
+    # pass used in the optim loop is compiled
+    loss_step = torch.compile(loss, mode="reduce-overhead") if args.compile else loss
+
+    path = Path("./output")
+
+    try:
+        print(
+            "Attempting to integrate with wandb; dismiss the following messages if you"
+            " have not set it up."
+        )
+        from torchrl.record import WandbLogger
+
+        logger = WandbLogger(
+            project="rlsnake",
+            exp_name=args.exp_name,
+            offline=args.offline,
+            tags=["surroundings", "dqn"] + args.tags,
+            config=args,
+        )
+    except Exception:
+        print("wandb unavailable; falling back to CSV logging.")
+        from torchrl.record import CSVLogger
+
+        logger = CSVLogger(exp_name=args.exp_name, log_dir=str(path))
+        logger.log_hparams(vars(args))
+
+    # Training loop
+
+    total_steps_in_training = 0
+    # Accumulated on-device; only read back to the host when logged
+    total_episodes = torch.zeros((), dtype=torch.int64)
+    t0 = time.time()
+    prev_max = 0
+    batch = None
+    widened = None
+    # Videos of new record trajectories are written out in the background so that
+    # training doesn't stall on them
+    renderer_pool = ThreadPoolExecutor(max_workers=1)
+    render_futures = []
+    for i, data in enumerate(collector):
+        if i % 10 == 0:
+            print(
+                f"{i}: len(rb)={len(rb)}, max={prev_max},"
+                f" eps={exploration_module.eps.item()}"
+            )
+        # Write data in replay buffer
+        rb.extend(obs_cast.inv(data.reshape(-1)))
+
+        total_steps_in_training += data.numel()
+        total_episodes += data["next", "done"].sum()
+
+        if len(rb) > args.init_rand_steps:
+            # Optim loop (we do several optim steps
+            # per batch collected for efficiency). The minibatches for all of the
+            # optim steps are gathered from the buffer in a single call.
+            samples = rb.sample(128 * args.optim_steps).reshape(args.optim_steps, 128)
+            if storage_device == device:
+                batch = samples
+            elif batch is None:
+                batch = samples.to(device)
+            else:
+                # Copy into the minibatches already on the device rather than
+                # allocating new ones; coming from pinned memory, the copy doesn't
+                # block the host
+                batch.copy_(samples, non_blocking=True)
+            if widened is None:
+                # Shallow copy, so that the reused 8-bit minibatches are left
+                # untouched
+                widened = obs_cast(batch.copy())
+            else:
+                # Widen into the float32 observations of the previous batch rather
+                # than allocating new ones; the other fields are shared with `batch`
+                for key in obs_keys:
+                    widened[key].copy_(batch[key])
+                widened.update(batch.exclude(*obs_keys))
+            for sample in widened:
+                if args.compile:
+                    torch.compiler.cudagraph_mark_step_begin()
+                with torch.autocast(device.type, torch.bfloat16, enabled=args.amp):
+                    loss_vals = loss_step(sample)
+                loss_vals["loss"].backward()
+                optim.step()
+                optim.zero_grad()
+                # Update exploration factor
+                # In theory, stepping by 100 each time and rb
+                exploration_module.step(data.numel())
+                # Update target params
+                updater.step()
+            if i % 10 == 0:
+
+                # Evaluate the policy without exploration
+
+                with set_exploration_type(
+                    ExplorationType.DETERMINISTIC
+                ), torch.no_grad():
+                    n_rollout = 2000
+                    rollout: TensorDict = env.rollout(n_rollout, policy_explore, break_when_any_done=False)  # type: ignore
+                    max_snake_length = rollout["next", "snake_length"].max().item()
+                    max_step_count = rollout["next", "step_count"].max().item()
+                    print(
+                        f"rollout({n_rollout}) max score: {max_snake_length}, max"
+                        f" episode steps: {max_step_count}"
+                    )
 
-collector = SyncDataCollector(
-    env,
-    policy_explore,
-    frames_per_batch=args.steps_per_batch,
-    total_frames=-1,
-    init_random_frames=args.init_rand_steps,
-    device=device,
-)
-rb = ReplayBuffer(storage=LazyTensorStorage(args.buffer_length, device=device))
+                    logger.log_scalar("Episode Score", max_snake_length)
+                    logger.log_scalar("Steps in Episode", max_step_count)
+                    logger.log_scalar("Total Training Steps", total_steps_in_training)
+                    logger.log_scalar("Total Episodes", total_episodes.item())
+                    logger.log_scalar("DQN Loss", loss_vals["loss"].item())
+                    logger.log_scalar("epsilon", exploration_module.eps.item())
 
-from torch.optim import Adam
+                    env.reset()
 
-# %%
-from torchrl.objectives import DQNLoss, SoftUpdate
+                    if max_snake_length > prev_max and max_snake_length > 5:
 
-loss = DQNLoss(value_network=policy, action_space=env.action_spec, delay_value=True)
-loss.make_value_estimator(gamma=args.gamma)
-optim = Adam(loss.parameters(), lr=args.adam_learning_rate)
-updater = SoftUpdate(loss, eps=0.99)
+                        # Pick out the specific trajectory that yielded the max and
+                        # save it as an asciinema video
 
-import time
+                        i_max = rollout["next", "snake_length"].argmax().item()
+                        i_start, i_end = episode_bounds(rollout["next", "done"], i_max)
 
-# %%
-from torchrl._utils import logger as torchrl_logger
-
-path = Path("./output")
+                        if rollout["next", "truncated"][i_end].item():
+                            print(
+                                "Warning: the trajectory which yielded a max score of"
+                                f" {max_snake_length} was truncated at"
+                                f" {args.max_episode_steps} steps."
+                            )
+                        logger.log_scalar("Overall Max Score", max_snake_length)
 
-try:
-    print(
-        "Attempting to integrate with wandb; dismiss the following messages if you have"
-        " not set it up."
-    )
-    from torchrl.record import WandbLogger
-
-    logger = WandbLogger(
-        project="rlsnake",
-        exp_name=args.exp_name,
-        offline=args.offline,
-        tags=["surroundings", "dqn"] + args.tags,
-        config=args,
-    )
-except Exception:
-    print("wandb unavailable; falling back to CSV logging.")
-    from torchrl.record import CSVLogger
-
-    logger = CSVLogger(exp_name=args.exp_name, log_dir=str(path))
-    logger.log_hparams(vars(args))
-
-# %%
-
-# Training loop
-
-total_steps_in_training = 0
-total_episodes = 0
-t0 = time.time()
-prev_max = 0
-for i, data in enumerate(collector):
-    print(f"{i}: len(rb)={len(rb)}, max={prev_max}, eps={exploration_module.eps}")
-    # Write data in replay buffer
-    rb.extend(data)
-
-    total_steps_in_training += data.numel()
-    total_episodes += data["next", "done"].sum()
-
-    if len(rb) > args.init_rand_steps:
-        # Optim loop (we do several optim steps
-        # per batch collected for efficiency)
-        for _ in range(args.optim_steps):
-            sample = rb.sample(128)
-            loss_vals = loss(sample)
-            loss_vals["loss"].backward()
-            optim.step()
-            optim.zero_grad()
-            # Update exploration factor
-            # In theory, stepping by 100 each time and rb
-            exploration_module.step(data.numel())
-            # Update target params
-            updater.step()
-        if i % 10 == 0:
-
-            # Evaluate the policy without exploration
-
-            with set_exploration_type(ExplorationType.DETERMINISTIC), torch.no_grad():
-                n_rollout = 2000
-                rollout: TensorDict = env.rollout(n_rollout, policy_explore, break_when_any_done=False)  # type: ignore
-                max_snake_length = rollout["next", "snake_length"].max()
-                max_step_count = rollout["next", "step_count"].max()
-                print(
-                    f"rollout({n_rollout}) max score: {max_snake_length}, max episode"
-                    f" steps: {rollout['next', 'step_count'].max().item()}"
-                )
-
-                logger.log_scalar("Episode Score", max_snake_length)
-                logger.log_scalar("Steps in Episode", max_step_count)
-                logger.log_scalar("Total Training Steps", total_steps_in_training)
-                logger.log_scalar("Total Episodes", total_episodes)
-                logger.log_scalar("DQN Loss", loss_vals["loss"].item())
-                logger.log_scalar("epsilon", exploration_module.eps)
-
-                env.reset()
-
-                if max_snake_length > prev_max and max_snake_length > 5:
-
-                    # Pick out the specific trajectory that yielded the max and
-                    # save it as an asciinema video
-
-                    i_max = rollout["next", "snake_length"].argmax()
-                    i_start = rollout["next", "done"][:i_max].argwhere()
-                    if i_start.numel() == 0:
-                        i_start = 0
-                    else:
-                        i_start = i_start[-1][0] + 1
-                    i_end = i_max + rollout["next", "done"][i_max:].argwhere()
-                    if i_end.numel() == 0:
-                        i_end = -1
-                    else:
-                        i_end = i_end[0, 0]
-
-                    if rollout["next", "truncated"][i_end].item():
                         print(
-                            "Warning: the trajectory which yielded a max score of"
-                            f" {max_snake_length} was truncated at"
-                            f" {args.max_episode_steps} steps."
+                            f"New max of {max_snake_length}; rb ="
+                            f" {len(rb):,}/{args.buffer_length:,}; eps ="
+                            f" {exploration_module.eps.item()}"
                         )
-                    logger.log_scalar("Overall Max Score", max_snake_length)
+                        prev_max = max_snake_length
 
-                    print(
-                        f"New max of {max_snake_length}; rb ="
-                        f" {len(rb):,}/{args.buffer_length:,}; eps ="
-                        f" {exploration_module.eps}"
-                    )
-                    prev_max = max_snake_length
+                        trajectory = rollout["next"][i_start : i_end + 1]
+
+                        video_dir = path / args.exp_name / "videos"
 
-                    trajectory = rollout["next"][i_start : i_end + 1]
+                        video_dir.mkdir(parents=True, exist_ok=True)
 
-                    video_dir = path / args.exp_name / "videos"
+                        video_path = video_dir / f"snake_length_{max_snake_length}.cast"
+                        render_futures.append(
+                            renderer_pool.submit(
+                                render_trajectory,
+                                str(video_path),
+                                SnakeGrid._render_as_string,
+                                tensordict=trajectory.cpu(),
+                            )
+                        )
 
-                    video_dir.mkdir(parents=True, exist_ok=True)
+                        # The board has been filled, so there is nothing left to
+                        # learn
+                        if prev_max == args.board_size**2:
+                            break
 
-                    render_trajectory(
-                        str(video_dir / f"snake_length_{max_snake_length}.cast"),
-                        SnakeGrid._render_as_string,
-                        tensordict=trajectory.cpu(),
-                    )
+    t1 = time.time()
 
-    if prev_max == args.board_size**2:
-        break
+    torchrl_logger.info(
+        f"done after {total_steps_in_training} steps, {total_episodes.item()} episodes"
+        " and in"
+        f" {t1-t0}s."
+    )
 
+    # Wait for any videos still being written, surfacing rendering errors
+    for future in render_futures:
+        future.result()
+    renderer_pool.shutdown()
 
-t1 = time.time()
+    final_rollout = env.rollout(max_steps=10000, break_when_any_done=False, policy=policy)  # type: ignore
 
-torchrl_logger.info(
-    f"done after {total_steps_in_training} steps, {total_episodes} episodes and in"
-    f" {t1-t0}s."
-)
+    final_max_snake_length = final_rollout["next", "snake_length"].max().item()
 
-final_rollout = env.rollout(max_steps=10000, break_when_any_done=False, policy=policy)  # type: ignore
+    if final_max_snake_length > prev_max:
+        logger.log_scalar("Overall Max Score", final_max_snake_length)
+        max_snake_length = final_max_snake_length
 
-final_max_snake_length = final_rollout["next", "snake_length"].max()
+    i_max = final_rollout["next", "snake_length"].argmax().item()
+    i_start, i_end = episode_bounds(final_rollout["next", "done"], i_max)
 
-if final_max_snake_length > prev_max:
-    logger.log_scalar("Overall Max Score", final_max_snake_length)
-    max_snake_length = final_max_snake_length
+    trajectory = final_rollout["next"][i_start : i_end + 1]
 
-i_max = final_rollout["next", "snake_length"].argmax()
-i_start = final_rollout["next", "done"][:i_max].argwhere()
-if i_start.numel() == 0:
-    i_start = 0
-else:
-    i_start = i_start[-1][0] + 1
-i_end = i_max + final_rollout["next", "done"][i_max:].argwhere()
-if i_end.numel() == 0:
-    i_end = -1
-else:
-    i_end = i_end[0, 0]
+    video_dir = path / args.exp_name / "videos"
 
-trajectory = final_rollout["next"][i_start : i_end + 1]
+    video_dir.mkdir(parents=True, exist_ok=True)
 
-video_dir = path / args.exp_name / "videos"
+    render_trajectory(
+        str(video_dir / f"max_final_{final_max_snake_length}.cast"),
+        SnakeGrid._render_as_string,
+        tensordict=trajectory.cpu(),
+    )
 
-video_dir.mkdir(parents=True, exist_ok=True)
+    torchrl_logger.info(
+        f"Final rollout max score: {final_max_snake_length} in {len(trajectory)} steps"
+    )
 
-render_trajectory(
-    str(video_dir / f"max_final_{final_max_snake_length}.cast"),
-    SnakeGrid._render_as_string,
-    tensordict=trajectory.cpu(),
-)
+    torchrl_logger.info(f"Overall max score: {prev_max}")
+
+    # Stops the worker processes of a multi-process collector (which would
+    # otherwise keep the program from exiting) and closes the env. This comes
+    # last since the single-process collector shares `env` with the final rollout.
+    collector.shutdown()
 
-torchrl_logger.info(
-    f"Final rollout max score: {final_max_snake_length} in {len(trajectory)} steps"
-)
 
-torchrl_logger.info(f"Overall max score: {prev_max}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import torch
+from tensordict.nn import TensorDictModuleBase
+from tensordict.utils import expand_as_right
+from torch.nn import functional as F
+from torchrl.data import OneHot
+from torchrl.envs.utils import ExplorationType, exploration_type
+
+
+class AnnealedEGreedyModule(TensorDictModuleBase):
+    """Epsilon-greedy exploration with a linearly annealed epsilon.
+
+    A drop-in for TorchRL's `EGreedyModule`, except that epsilon is derived from a
+    frame counter kept on the module's device, so neither `step` nor the forward
+    pass needs to read anything back to the host. Random actions are drawn directly
+    on the device of the greedy actions (one-hot encoded for one-hot action specs)
+    rather than sampled from the spec.
+    """
+
+    def __init__(
+        self,
+        spec,
+        eps_init=1.0,
+        eps_end=0.1,
+        annealing_num_steps=1000,
+        action_key="action",
+    ):
+        if eps_init < eps_end:
+            raise RuntimeError("eps_init should be greater or equal to eps_end")
+        super().__init__()
+        self.spec = spec
+        self.action_key = action_key
+        self.in_keys = [action_key]
+        self.out_keys = [action_key]
+        self.annealing_num_steps = annealing_num_steps
+        self.register_buffer("eps_init", torch.as_tensor(eps_init, dtype=torch.float32))
+        self.register_buffer("eps_end", torch.as_tensor(eps_end, dtype=torch.float32))
+        self.register_buffer("frames", torch.zeros((), dtype=torch.int64))
+
+    @property
+    def eps(self):
+        progress = (self.frames / self.annealing_num_steps).clamp(max=1.0)
+        return self.eps_init + (self.eps_end - self.eps_init) * progress
+
+    def step(self, frames=1):
+        self.frames += frames
+
+    def forward(self, tensordict):
+        if exploration_type() in (ExplorationType.RANDOM, None):
+            action = tensordict.get(self.action_key)
+            explore = torch.rand(tensordict.shape, device=action.device) < self.eps
+            if isinstance(self.spec, OneHot):
+                n = action.shape[-1]
+                random_action = F.one_hot(
+                    torch.randint(n, action.shape[:-1], device=action.device), n
+                ).to(action.dtype)
+            else:
+                random_action = torch.randint(
+                    self.spec.space.n, action.shape, device=action.device
+                ).to(action.dtype)
+            tensordict.set(
+                self.action_key,
+                torch.where(expand_as_right(explore, action), random_action, action),
+            )
+        return tensordict
@@ -1,9 +1,11 @@
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cli_grid
 import torch
 import tqdm
+from exploration import AnnealedEGreedyModule
 from snake.envs import SnakeGrid
 from snake.render.asciinema import render_trajectory
 from tensordict.nn import TensorDictModule as Mod
@@ -14,6 +16,7 @@ from torchrl.collectors import SyncDataCollector
 from torchrl.data import LazyMemmapStorage, TensorDictReplayBuffer
 from torchrl.envs import (
     Compose,
+    DTypeCastTransform,
     ExplorationType,
     InitTracker,
     StepCounter,
@@ -22,8 +25,9 @@ from torchrl.envs import (
     set_exploration_type,
 )
 from torchrl.envs.libs.gym import GymEnv
-from torchrl.modules import MLP, ConvNet, EGreedyModule, LSTMModule, QValueModule
+from torchrl.modules import MLP, ConvNet, LSTMModule, QValueModule
 from torchrl.objectives import DQNLoss, SoftUpdate
+from trajectories import episode_bounds
 
 # Parse arguments and set up environment, transforming outputs as needed to
 # make them compatible with the inputs of our approximation modules
@@ -39,7 +43,9 @@ device = (
 
 
 env = TransformedEnv(
-    GymEnv("snake/SnakeGrid", render_mode="ansi", device=device),
+    GymEnv(
+        "snake/SnakeGrid", size=args.board_size, render_mode="ansi", device=device
+    ),
     Compose(
         UnsqueezeTransform(-3, in_keys="observation"),
         StepCounter(max_steps=2000),
@@ -65,6 +71,9 @@ feature = Mod(
 )
 
 n_cells = feature(env.reset())["embed"].shape[-1]
+# The first conv layer is lazy, so the weights can only be switched to the
+# channels-last memory format once a forward pass has materialized them
+feature.to(memory_format=torch.channels_last)
 
 lstm = LSTMModule(
     input_size=n_cells,
@@ -88,7 +97,7 @@ qval = QValueModule(spec=env.action_spec)
 
 stoch_policy = Seq(feature, lstm, mlp, qval)
 
-exploration_module = EGreedyModule(
+exploration_module = AnnealedEGreedyModule(
     annealing_num_steps=args.annealing_steps,
     spec=env.action_spec,
     eps_init=args.epsilon_bounds[0],
@@ -109,7 +118,11 @@ loss_fn.make_value_estimator(gamma=args.gamma)
 
 updater = SoftUpdate(loss_fn, eps=0.95)
 
-optim = torch.optim.Adam(policy.parameters(), lr=args.adam_learning_rate)
+# The fused implementation updates all of the (small) parameter tensors in a
+# single kernel
+optim = torch.optim.Adam(
+    policy.parameters(), lr=args.adam_learning_rate, fused=device.type == "cuda"
+)
 
 # Set up interfaces for storing data and sampling rollouts
 
@@ -119,12 +132,24 @@ collector = SyncDataCollector(
     frames_per_batch=args.steps_per_batch,
     total_frames=args.total_steps,
 )
+# The observations hold board state values from 0 to 4, so they are stored as
+# uint8 and only cast back to float32 once a sampled minibatch is on the training
+# device (keeping host-to-device copies small too)
+obs_keys = ["observation", ("next", "observation")]
+obs_cast = DTypeCastTransform(
+    torch.uint8, torch.float32, in_keys=obs_keys, in_keys_inv=obs_keys
+)
 rb = TensorDictReplayBuffer(
-    storage=LazyMemmapStorage(args.buffer_length), batch_size=4, prefetch=10
+    storage=LazyMemmapStorage(args.buffer_length),
+    batch_size=4,
+    prefetch=10,
+    pin_memory=device.type == "cuda",
 )
 
 pbar = tqdm.tqdm(total=collector.total_frames)
-longest = 0
+# The running max is kept on the same device as the collected data and is only
+# read back to the host when it is logged
+longest = torch.zeros((), dtype=torch.int64, device=device)
 
 path = Path("./output")
 try:
@@ -152,32 +177,38 @@ except Exception:
 
 traj_lens = []
 max_deterministic = 0
+# Videos of new record trajectories are written out in the background so that
+# training doesn't stall on them
+renderer_pool = ThreadPoolExecutor(max_workers=1)
+render_futures = []
 for i, data in enumerate(collector):
     pbar.update(data.numel())
     # it is important to pass data that is not flattened
-    rb.extend(data.unsqueeze(0).to_tensordict().cpu())
+    rb.extend(obs_cast.inv(data.unsqueeze(0).to_tensordict()).cpu())
     for _ in range(args.optim_steps):
-        s = rb.sample().to(device, non_blocking=True)
+        s = obs_cast(rb.sample().to(device, non_blocking=True))
         loss_vals = loss_fn(s)
         loss_vals["loss"].backward()
         optim.step()
         optim.zero_grad()
-    longest = max(longest, data["next", "snake_length"].max().item())
-    max_steps = data["next", "step_count"].max().item()
-    pbar.set_description(
-        f"max score: {longest}, loss_val: {loss_vals['loss'].item(): 4.4f}, eps:"
-        f" {exploration_module.eps}"
-    )
+    longest = torch.maximum(longest, data["next", "snake_length"].max())
+    max_steps = data["next", "step_count"].max()
     exploration_module.step(data.numel())
     updater.step()
 
     if i % 10 == 0:
+        pbar.set_description(
+            f"max score: {longest.item()}, loss_val:"
+            f" {loss_vals['loss'].item(): 4.4f}, eps: {exploration_module.eps.item()}"
+        )
 
         # Evaluate the policy without exploration
 
-        logger.log_scalar(f"Max steps in batch of {args.steps_per_batch}", max_steps)
-        logger.log_scalar("epsilon", exploration_module.eps)
-        logger.log_scalar(f"Max Score Across All Training Steps", longest)
+        logger.log_scalar(
+            f"Max steps in batch of {args.steps_per_batch}", max_steps.item()
+        )
+        logger.log_scalar("epsilon", exploration_module.eps.item())
+        logger.log_scalar(f"Max Score Across All Training Steps", longest.item())
         logger.log_scalar("DQN Loss", loss_vals["loss"].item())
         with set_exploration_type(ExplorationType.DETERMINISTIC), torch.no_grad():
             n_rollout = 1000
@@ -193,17 +224,8 @@ for i, data in enumerate(collector):
 
                 max_deterministic = max_len
 
-                i_max = rollout["next", "snake_length"].argmax()
-                i_start = rollout["next", "done"][:i_max].argwhere()
-                if i_start.numel() == 0:
-                    i_start = 0
-                else:
-                    i_start = i_start[-1][0] + 1
-                i_end = i_max + rollout["next", "done"][i_max:].argwhere()
-                if i_end.numel() == 0:
-                    i_end = -1
-                else:
-                    i_end = i_end[0, 0]
+                i_max = rollout["next", "snake_length"].argmax().item()
+                i_start, i_end = episode_bounds(rollout["next", "done"], i_max)
 
                 if rollout["next", "truncated"][i_end].item():
                     print(
@@ -218,11 +240,19 @@ for i, data in enumerate(collector):
 
                 video_dir.mkdir(parents=True, exist_ok=True)
 
-                render_trajectory(
-                    str(video_dir / f"snake_length_{max_len}.cast"),
-                    SnakeGrid._render_as_string,
-                    tensordict=trajectory.cpu(),
+                render_futures.append(
+                    renderer_pool.submit(
+                        render_trajectory,
+                        str(video_dir / f"snake_length_{max_len}.cast"),
+                        SnakeGrid._render_as_string,
+                        tensordict=trajectory.cpu(),
+                    )
                 )
 
             traj_lens.append(max_len)
             env.reset()
+
+# Wait for any videos still being written, surfacing rendering errors
+for future in render_futures:
+    future.result()
+renderer_pool.shutdown()
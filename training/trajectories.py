@@ -0,0 +1,16 @@
+import torch
+
+
+def episode_bounds(done, i_max):
+    """Returns the indices of the first and last steps of the episode containing
+    step `i_max`, given the `done` flags of a rollout.
+
+    The boundaries are found by a binary search over the (sorted) indices of the
+    terminal steps. An episode that hasn't finished by the end of the rollout ends
+    at the rollout's last step.
+    """
+    done_indices = done.squeeze(-1).nonzero()[:, 0]
+    pos = torch.searchsorted(done_indices, i_max).item()
+    i_start = 0 if pos == 0 else done_indices[pos - 1].item() + 1
+    i_end = len(done) - 1 if pos == done_indices.numel() else done_indices[pos].item()
+    return i_start, i_end